@@ -40,7 +40,6 @@ export async function POST(request: NextRequest) {
 
   try {
     const buffer = await readFile(filePath);
-    const videoBase64 = buffer.toString("base64");
 
     console.log(
       `[segment] Starting Modal segmentation for ${videoId} (${buffer.length} bytes)`
@@ -53,8 +52,8 @@ export async function POST(request: NextRequest) {
 
     const modalRes = await fetch(MODAL_ENDPOINT_URL, {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ video_base64: videoBase64 }),
+      headers: { "Content-Type": "video/mp4" },
+      body: new Uint8Array(buffer),
       signal: controller.signal,
     });
 
@@ -65,19 +64,14 @@ export async function POST(request: NextRequest) {
       throw new Error(`Modal returned ${modalRes.status}: ${errorText}`);
     }
 
-    const result = await modalRes.json();
+    const maskBuffer = Buffer.from(await modalRes.arrayBuffer());
     const elapsed = ((Date.now() - startTime) / 1000).toFixed(1);
 
-    if (result.error) {
-      throw new Error(result.error);
-    }
-
     console.log(
-      `[segment] Modal segmentation done in ${elapsed}s (${result.num_frames} frames)`
+      `[segment] Modal segmentation done in ${elapsed}s (${modalRes.headers.get("x-num-frames")} frames)`
     );
 
-    // Decode and save mask video to disk
-    const maskBuffer = Buffer.from(result.mask_video_base64, "base64");
+    // Save mask video to disk
     await mkdir(VIDEO_DIR, { recursive: true });
     await writeFile(maskPath(videoId), maskBuffer);
 
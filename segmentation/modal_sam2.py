@@ -1,9 +1,15 @@
+import functools
+import os
 from pathlib import Path
 import modal
 
 MODEL_TYPE = "facebook/sam2-hiera-large"
 SAM2_GIT_SHA = "c2ec8e14a185632b0a5d8b161928ceb50197eddc"
 
+# SAM2 trains at 1024, but Hiera's windowed pos-embeds interpolate fine at 512
+# and a quarter of the tokens makes the image encoder ~4x cheaper
+SAM2_IMAGE_SIZE = 512
+
 image = (
     modal.Image.debian_slim(python_version="3.10")
     .apt_install("git", "wget", "python3-opencv", "ffmpeg")
@@ -16,6 +22,9 @@ image = (
         "onnx==1.17.0",
         "huggingface_hub==0.25.2",
         "ffmpeg-python==0.2.0",
+        "av==12.3.0",
+        "tensorrt~=10.3.0",
+        "blake3",
         "fastapi",
         f"git+https://github.com/facebookresearch/sam2.git@{SAM2_GIT_SHA}",
     )
@@ -26,46 +35,651 @@ app = modal.App("jigglewiggle-sam2", image=image)
 cache_vol = modal.Volume.from_name("hf-hub-cache", create_if_missing=True)
 cache_dir = "/cache"
 
+# Per-request scratch, kept apart from the model cache so chunk workers can
+# reload it freely and a crashed request never leaves files in the cache
+jobs_vol = modal.Volume.from_name("jigglewiggle-sam2-jobs", create_if_missing=True)
+jobs_dir = "/jobs"
+
 # Parallel processing config
 # Modal allows max 10 concurrent GPUs
 # Reserve 2 (orchestrator + buffer), use up to 8 for chunks
 MAX_PARALLEL_CHUNKS = 8
+# Every chunk pays a container start plus SAM2 warmup, so below this many
+# frames splitting costs more than it saves
+MIN_FRAMES_PER_CHUNK = 48
+# Below this IoU between a chunk's first mask and the previous chunk's last
+# mask, the chunk is assumed to have locked onto a different object
+HANDOFF_MIN_IOU = 0.5
+# Each re-seed re-decodes, re-encodes and re-tracks a whole chunk serially on
+# the orchestrator, so at most this many run per request
+MAX_RESEEDS = 2
+
+# Enough frames to fill SAM2's memory bank and object pointer window, so every
+# memory attention shape is compiled and captured before the first request
+WARMUP_FRAMES = 20
+
+# Output bytes per program in the mask bit-packing kernel
+PACK_BLOCK = 256
+
+# SAM2 frame preprocessing (matches sam2.utils.misc.load_video_frames)
+SAM2_IMG_MEAN = (0.485, 0.456, 0.406)
+SAM2_IMG_STD = (0.229, 0.224, 0.225)
+DECODE_BATCH_SIZE = 32
+
+# TensorRT build of the SAM2 image encoder, baked into the image at build time
+TRT_ENGINE_PATH = "/root/sam2_image_encoder.plan"
+TRT_FPN_OUTPUTS = ("fpn_0", "fpn_1", "fpn_2")
+
+# SAM2 weights as a CUDA state_dict, written by export_weights. Keyed by model
+# and SAM2 revision so bumping either never loads a stale or mismatched file.
+WEIGHTS_PATH = Path(cache_dir) / (
+    f"{MODEL_TYPE.replace('/', '--')}-{SAM2_GIT_SHA[:12]}.cuda.pt"
+)
 
+# Per-chunk image encoder outputs, keyed by video content hash. Off by default:
+# a miss writes ~2 MiB per frame to the volume before the chunk returns, which
+# only pays off when the same clips are segmented again, and the web app
+# already caches mask videos per upload. Enable with
+# SAM2_FEATURE_CACHE=1 modal deploy modal_sam2.py
+FEATURE_CACHE = os.environ.get("SAM2_FEATURE_CACHE") == "1"
+FEATURE_CACHE_DIR = Path(cache_dir) / "feat"
+# Inductor compiles into local disk (Triton launchers are dlopen'd from it);
+# the volume only keeps a snapshot that containers copy in at startup
+INDUCTOR_CACHE_DIR = "/root/inductor-cache"
+INDUCTOR_CACHE_SNAPSHOT = Path(cache_dir) / "inductor"
+
+# Oldest feature files are evicted once the cache grows past this
+FEATURE_CACHE_MAX_BYTES = 20 << 30
+# Per-request chunk files, read by workers instead of pickling JPEG bytes.
+# Job directories left behind by crashed requests are removed after this long.
+JOB_DIR = Path(jobs_dir)
+JOB_MAX_AGE_SECONDS = 3600
+
+
+def _load_predictor(image_size: int = SAM2_IMAGE_SIZE, weights_path: Path | None = WEIGHTS_PATH):
+    """Build the SAM2 video predictor on the GPU at the given input resolution.
+
+    Weights come from the state_dict at weights_path when it exists, otherwise
+    from the Hugging Face hub checkpoint.
+    """
+    import torch
+    from sam2.build_sam import HF_MODEL_ID_TO_FILENAMES, build_sam2_video_predictor
+    from sam2.sam2_video_predictor import SAM2VideoPredictor
+
+    hydra_overrides_extra = [f"++model.image_size={image_size}"]
+    if weights_path is None or not weights_path.exists():
+        return SAM2VideoPredictor.from_pretrained(
+            MODEL_TYPE,
+            hydra_overrides_extra=hydra_overrides_extra,
+        )
 
-@app.cls(
-    image=image.env({"HF_HUB_CACHE": cache_dir}),
+    config_name, _ = HF_MODEL_ID_TO_FILENAMES[MODEL_TYPE]
+    with torch.device("cuda"):
+        predictor = build_sam2_video_predictor(
+            config_name,
+            ckpt_path=None,
+            hydra_overrides_extra=hydra_overrides_extra,
+        )
+    # The model is built directly on the GPU and adopts the loaded tensors as
+    # its parameters, so no CPU copy of the model is initialized or moved
+    state_dict = torch.load(weights_path, map_location="cuda", weights_only=True)
+    predictor.load_state_dict(state_dict, assign=True)
+    return predictor
+
+
+def _install_frame_loader():
+    """Let SAM2's init_state accept preprocessed frames instead of a JPEG folder."""
+    import sam2.sam2_video_predictor as sam2_video_predictor
+
+    load_video_frames = sam2_video_predictor.load_video_frames
+
+    def load_preprocessed_frames(video_path, **kwargs):
+        # (images, video_height, video_width) as returned by _decode_frames
+        if isinstance(video_path, tuple):
+            return video_path
+        return load_video_frames(video_path=video_path, **kwargs)
+
+    sam2_video_predictor.load_video_frames = load_preprocessed_frames
+
+
+def _install_feature_cache(predictor):
+    """Serve and record per-frame image features through predictor.frame_features.
+
+    SAM2 only keeps the latest frame's backbone output in inference_state, so
+    this keeps every frame's features for a chunk where they can be persisted.
+    """
+    import torch
+
+    get_image_feature = predictor._get_image_feature
+    predictor.frame_features = None
+
+    def _get_image_feature(inference_state, frame_idx, batch_size):
+        store = predictor.frame_features
+        if store is not None and frame_idx in store["backbone_fpn"]:
+            # Stored as bf16 to halve the files; restore each level's own dtype
+            # (they differ under autocast) so the compiled memory attention and
+            # mask decoder see the same inputs on hits and misses
+            backbone_fpn = [
+                feat.to(dtype)
+                for feat, dtype in zip(store["backbone_fpn"][frame_idx], store["fpn_dtypes"])
+            ]
+            image = inference_state["images"][frame_idx].to(inference_state["device"])
+            inference_state["cached_features"] = {
+                frame_idx: (
+                    image.float().unsqueeze(0),
+                    {
+                        "vision_features": backbone_fpn[-1],
+                        "vision_pos_enc": store["vision_pos_enc"],
+                        "backbone_fpn": backbone_fpn,
+                    },
+                )
+            }
+
+        result = get_image_feature(inference_state, frame_idx, batch_size)
+
+        if store is not None and frame_idx not in store["backbone_fpn"]:
+            _, backbone_out = inference_state["cached_features"][frame_idx]
+            store["backbone_fpn"][frame_idx] = [
+                feat.to(torch.bfloat16) for feat in backbone_out["backbone_fpn"]
+            ]
+            # Positional encodings and dtypes only depend on the encoder
+            store.setdefault("vision_pos_enc", backbone_out["vision_pos_enc"])
+            store.setdefault("fpn_dtypes", [feat.dtype for feat in backbone_out["backbone_fpn"]])
+        return result
+
+    predictor._get_image_feature = _get_image_feature
+
+
+def _install_prompt_cache(predictor):
+    """Memoize prompt encoder outputs under predictor.prompt_cache_key.
+
+    Callers set the key while the prompt is known to be identical (same center
+    point, or the empty prompt used on every propagated frame), so lookups
+    never need to read the prompt tensors back from the GPU.
+    """
+    prompt_encoder = predictor.sam_prompt_encoder
+    forward = prompt_encoder.forward
+    cache = {}
+    predictor.prompt_cache_key = None
+
+    def cached_forward(points, boxes, masks):
+        key = predictor.prompt_cache_key
+        if key is None or boxes is not None or masks is not None:
+            return forward(points=points, boxes=boxes, masks=masks)
+        if key not in cache:
+            cache[key] = forward(points=points, boxes=boxes, masks=masks)
+        return cache[key]
+
+    prompt_encoder.forward = cached_forward
+
+
+def _evict_features(max_bytes: int):
+    """Delete the oldest cached feature files until the rest fit in max_bytes."""
+    entries = sorted(
+        ((path, path.stat()) for path in FEATURE_CACHE_DIR.glob("*.pt")),
+        key=lambda entry: entry[1].st_mtime,
+        reverse=True,
+    )
+    total = 0
+    for path, stat in entries:
+        total += stat.st_size
+        if total > max_bytes:
+            path.unlink(missing_ok=True)
+
+
+def _copy_missing_files(src: Path, dst: Path) -> bool:
+    """Copy files under src that dst lacks; return whether anything was copied."""
+    import shutil
+
+    copied = False
+    if not src.exists():
+        return copied
+    for path in src.rglob("*"):
+        target = dst / path.relative_to(src)
+        if path.is_file() and not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(path, target)
+            copied = True
+    return copied
+
+
+def _compile_cudagraphs(module):
+    """torch.compile a module's forward with CUDA graphs (mode="reduce-overhead").
+
+    Graph replays reuse their output buffers, while SAM2 keeps outputs around
+    across frames, so each step is marked and its outputs are cloned.
+    """
+    import torch
+    import torch._inductor.config
+    from torch.utils._pytree import tree_map
+
+    torch._inductor.config.triton.cudagraphs = True
+    compiled_forward = torch.compile(module.forward, mode="reduce-overhead", fullgraph=False)
+
+    def forward(*args, **kwargs):
+        torch.compiler.cudagraph_mark_step_begin()
+        outputs = compiled_forward(*args, **kwargs)
+        return tree_map(
+            lambda x: x.clone() if isinstance(x, torch.Tensor) else x, outputs
+        )
+
+    module.forward = forward
+
+
+@functools.cache
+def _mask_pack_kernel():
+    import triton
+    import triton.language as tl
+
+    @triton.jit
+    def pack_mask(logits_ptr, out_ptr, height, width, row_bytes, BLOCK: tl.constexpr):
+        # Each lane owns one output byte: 8 adjacent pixels of a row, MSB first
+        offs = tl.program_id(0) * BLOCK + tl.arange(0, BLOCK)
+        row = offs // row_bytes
+        cols = (offs % row_bytes)[:, None] * 8 + tl.arange(0, 8)[None, :]
+        valid = (row < height)[:, None] & (cols < width)
+        logits = tl.load(logits_ptr + row[:, None] * width + cols, mask=valid, other=0.0)
+        weights = tl.full((8,), 128, tl.int32) >> tl.arange(0, 8)
+        packed = tl.sum((logits > 0).to(tl.int32) * weights[None, :], axis=1)
+        tl.store(out_ptr + offs, packed.to(tl.uint8), mask=row < height)
+
+    return pack_mask
+
+
+def _pack_mask(logits, out):
+    """Threshold [H, W] logits at 0 into out as np.packbits-style rows (ffmpeg monob)."""
+    import triton
+
+    height, width = logits.shape
+    row_bytes = out.shape[-1]
+    grid = (triton.cdiv(height * row_bytes, PACK_BLOCK),)
+    _mask_pack_kernel()[grid](logits, out, height, width, row_bytes, BLOCK=PACK_BLOCK)
+
+
+def _decode_frames(frame_jpegs: list[memoryview], image_size: int):
+    """Decode writable JPEG buffers with nvJPEG and resize/normalize them on the GPU for SAM2."""
+    import torch
+    import torch.nn.functional as F
+    from torchvision.io import ImageReadMode, decode_jpeg
+
+    mean = torch.tensor(SAM2_IMG_MEAN, device="cuda").view(1, 3, 1, 1)
+    std = torch.tensor(SAM2_IMG_STD, device="cuda").view(1, 3, 1, 1)
+    images = torch.empty(
+        (len(frame_jpegs), 3, image_size, image_size),
+        dtype=torch.float32,
+        device="cuda",
+    )
+
+    for start in range(0, len(frame_jpegs), DECODE_BATCH_SIZE):
+        batch = frame_jpegs[start:start + DECODE_BATCH_SIZE]
+        decoded = decode_jpeg(
+            [torch.frombuffer(b, dtype=torch.uint8) for b in batch],
+            mode=ImageReadMode.RGB,
+            device="cuda",
+        )
+        frames = torch.stack(decoded).float().div_(255.0)
+        frames = F.interpolate(
+            frames,
+            size=(image_size, image_size),
+            mode="bilinear",
+            align_corners=False,
+            antialias=True,
+        )
+        images[start:start + len(batch)] = (frames - mean) / std
+
+    video_height, video_width = decoded[0].shape[-2:]
+    return images, video_height, video_width
+
+
+def _stream_jpegs(input_path: Path):
+    """Yield JPEG frames from an ffmpeg MJPEG pipe as soon as each one is decoded."""
+    import subprocess
+    import tempfile
+
+    import ffmpeg
+
+    cmd = (
+        ffmpeg.input(str(input_path))
+        .output("pipe:", format="image2pipe", vcodec="mjpeg", qscale=2)
+        .global_args("-loglevel", "error")
+        .compile()
+    )
+    # stderr goes to a file: a damaged upload can log errors for every frame,
+    # and an undrained stderr pipe would stall ffmpeg while stdout is read
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            pending = bytearray()
+            while data := proc.stdout.read1(1 << 20):
+                pending += data
+                start = 0
+                while (end := pending.find(b"\xff\xd9", start)) != -1:
+                    yield bytes(pending[start:end + 2])
+                    start = end + 2
+                del pending[:start]
+
+            if proc.wait() != 0:
+                stderr.seek(0, os.SEEK_END)
+                stderr.seek(max(0, stderr.tell() - 500))
+                raise RuntimeError(f"ffmpeg failed: {stderr.read().decode(errors='replace')}")
+        finally:
+            # A consumer that stops early would leave ffmpeg blocked on a full pipe
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+
+def _estimate_frame_count(container, video_stream, fps: float) -> int:
+    """Frame count from container metadata, falling back to duration * fps."""
+    import av
+
+    if video_stream.frames:
+        return video_stream.frames
+    if video_stream.duration and video_stream.time_base:
+        duration = float(video_stream.duration * video_stream.time_base)
+    elif container.duration:
+        duration = container.duration / av.time_base
+    else:
+        return 0
+    return round(duration * fps)
+
+
+def _mask_iou(a, b) -> float:
+    """IoU of two bit-packed masks; 1.0 when both are empty."""
+    import numpy as np
+
+    union = np.count_nonzero(np.unpackbits(a | b))
+    return np.count_nonzero(np.unpackbits(a & b)) / union if union else 1.0
+
+
+def _encode_mask_video(chunk_masks, width: int, height: int, fps: float, output_path: Path):
+    """Pipe [T, H, ceil(W/8)] bit-packed masks into a single libx264 encode as rawvideo."""
+    import subprocess
+
+    cmd = [
+        "ffmpeg", "-y",
+        "-loglevel", "error",
+        "-f", "rawvideo",
+        "-pix_fmt", "monob",
+        "-s", f"{width}x{height}",
+        "-framerate", str(fps),
+        "-i", "-",
+        "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+        "-c:v", "libx264",
+        "-pix_fmt", "yuv420p",
+        str(output_path),
+    ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        for masks in chunk_masks:
+            proc.stdin.write(masks)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass  # ffmpeg exited early, its stderr says why
+    stderr = proc.stderr.read().decode()
+    if proc.wait() != 0:
+        print(f"ffmpeg stderr: {stderr}")
+        raise RuntimeError(f"ffmpeg failed: {stderr[-500:]}")
+
+
+def _build_trt_engine(image_size: int):
+    """Export SAM2's image encoder to ONNX and build a BF16 TensorRT engine from it."""
+    import tempfile
+
+    import tensorrt as trt
+    import torch
+
+    class BackboneFPN(torch.nn.Module):
+        # vision_pos_enc only depends on the feature shapes, so it stays in PyTorch
+        def __init__(self, image_encoder):
+            super().__init__()
+            self.image_encoder = image_encoder
+
+        def forward(self, image):
+            return tuple(self.image_encoder(image)["backbone_fpn"])
+
+    predictor = _load_predictor(image_size)
+    onnx_path = Path(tempfile.mkdtemp()) / "image_encoder.onnx"
+    with torch.no_grad():
+        torch.onnx.export(
+            BackboneFPN(predictor.image_encoder),
+            torch.zeros(1, 3, image_size, image_size, device="cuda"),
+            str(onnx_path),
+            input_names=["image"],
+            output_names=list(TRT_FPN_OUTPUTS),
+            opset_version=17,
+        )
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(0)
+    parser = trt.OnnxParser(network, logger)
+    if not parser.parse_from_file(str(onnx_path)):
+        errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+        raise RuntimeError(f"ONNX parse failed: {errors}")
+
+    config = builder.create_builder_config()
+    # A100 has no FP8 tensor cores; BF16 matches the autocast dtype used at inference
+    config.set_flag(trt.BuilderFlag.BF16)
+    config.builder_optimization_level = 5
+    engine = builder.build_serialized_network(network, config)
+    if engine is None:
+        raise RuntimeError("TensorRT engine build failed")
+
+    Path(TRT_ENGINE_PATH).write_bytes(engine)
+    print(f"TensorRT engine built at {image_size}x{image_size}")
+
+
+class _TRTImageEncoder:
+    """Stand-in for SAM2's ImageEncoder.forward that runs the baked TensorRT engine."""
+
+    def __init__(self, engine_path: str, neck):
+        import tensorrt as trt
+        import torch
+
+        runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+        self.engine = runtime.deserialize_cuda_engine(Path(engine_path).read_bytes())
+        self.context = self.engine.create_execution_context()
+
+        # Pre-allocated output bindings, reused for every frame
+        self.outputs = []
+        for name in TRT_FPN_OUTPUTS:
+            buf = torch.empty(
+                tuple(self.engine.get_tensor_shape(name)),
+                dtype=torch.float32,
+                device="cuda",
+            )
+            self.context.set_tensor_address(name, buf.data_ptr())
+            self.outputs.append(buf)
+
+        with torch.inference_mode():
+            self.pos_enc = [neck.position_encoding(buf).to(buf.dtype) for buf in self.outputs]
+
+    def __call__(self, sample):
+        import torch
+
+        sample = sample.float().contiguous()
+        self.context.set_tensor_address("image", sample.data_ptr())
+        self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream)
+
+        # SAM2 keeps features across frames, so copy them out of the bindings
+        backbone_fpn = [buf.clone() for buf in self.outputs]
+        return {
+            "vision_features": backbone_fpn[-1],
+            "vision_pos_enc": list(self.pos_enc),
+            "backbone_fpn": backbone_fpn,
+        }
+
+
+sam2_image = image.env(
+    {
+        "HF_HUB_CACHE": cache_dir,
+        "TORCHINDUCTOR_CACHE_DIR": INDUCTOR_CACHE_DIR,
+        "TORCHINDUCTOR_FX_GRAPH_CACHE": "1",
+        # Carry the deploy-time switch into the containers
+        "SAM2_FEATURE_CACHE": "1" if FEATURE_CACHE else "0",
+    }
+).run_function(
+    _build_trt_engine,
+    gpu="A100",
+    kwargs=dict(image_size=SAM2_IMAGE_SIZE),
     volumes={cache_dir: cache_vol},
+)
+
+with sam2_image.imports():
+    import fastapi
+    import numpy as np
+
+
+@app.function(image=sam2_image, gpu="A100", volumes={cache_dir: cache_vol})
+def export_weights():
+    """Save SAM2's hub weights to cache_vol for faster cold starts.
+
+    Run once per deploy: modal run modal_sam2.py::export_weights
+    """
+    import torch
+
+    predictor = _load_predictor(weights_path=None)
+    torch.save(predictor.state_dict(), WEIGHTS_PATH)
+    cache_vol.commit()
+    print(f"Saved weights to {WEIGHTS_PATH}")
+
+
+@app.cls(
+    image=sam2_image,
+    volumes={cache_dir: cache_vol, jobs_dir: jobs_vol},
     gpu="A100",
     scaledown_window=300,
 )
 class SAM2Model:
     @modal.enter()
     def load_model(self):
-        from sam2.sam2_video_predictor import SAM2VideoPredictor
+        from concurrent.futures import ThreadPoolExecutor
+
+        # CUDA graph trees are thread-local, so compilation, warmup and every
+        # later propagation run on this one thread
+        self.gpu_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sam2-gpu")
+
+        self.video_predictor = _load_predictor()
+        _install_frame_loader()
+        _install_feature_cache(self.video_predictor)
+        _install_prompt_cache(self.video_predictor)
+
+        if Path(TRT_ENGINE_PATH).exists():
+            image_encoder = self.video_predictor.image_encoder
+            image_encoder.forward = _TRTImageEncoder(TRT_ENGINE_PATH, image_encoder.neck)
+            print("Using TensorRT image encoder")
+
+        # Per-frame tracking runs the same small kernels at fixed shapes, so
+        # launch overhead is worth capturing into CUDA graphs. Earlier
+        # containers' compiled kernels are reused; only a container that had
+        # to compile something new writes back to the volume.
+        _copy_missing_files(INDUCTOR_CACHE_SNAPSHOT, Path(INDUCTOR_CACHE_DIR))
+        _compile_cudagraphs(self.video_predictor.memory_attention)
+        _compile_cudagraphs(self.video_predictor.sam_mask_decoder)
+        self.gpu_thread.submit(self._warmup).result()
+        if _copy_missing_files(Path(INDUCTOR_CACHE_DIR), INDUCTOR_CACHE_SNAPSHOT):
+            cache_vol.commit()
 
-        self.video_predictor = SAM2VideoPredictor.from_pretrained(MODEL_TYPE)
         print("SAM2 model loaded")
 
+    def _warmup(self):
+        """Track a blank clip so compilation and graph capture happen before requests."""
+        import time
+
+        import torch
+
+        t0 = time.time()
+        size = self.video_predictor.image_size
+        frames = torch.zeros((WARMUP_FRAMES, 3, size, size), device="cuda")
+        self._propagate((frames, size, size), size, size)
+        print(f"Warmup: {time.time() - t0:.1f}s")
+
     @modal.method()
-    def segment_chunk(self, frame_jpegs: list[bytes], width: int, height: int) -> list[bytes]:
-        """Process a chunk of frames, return PNG mask bytes for each frame."""
-        import io
-        import tempfile
+    def segment_chunk(
+        self,
+        chunk_path: str,
+        frame_offsets: list[int],
+        width: int,
+        height: int,
+        feature_key: str | None = None,
+        prompt_mask: "np.ndarray | None" = None,
+    ) -> "np.ndarray":
+        """Process a chunk of frames, return [T, H, ceil(W/8)] bit-packed masks.
+
+        chunk_path is a file of back-to-back JPEGs on jobs_vol, frame i spanning
+        frame_offsets[i]:frame_offsets[i + 1]. By default the first frame is
+        prompted with its center point; pass the previous chunk's last mask as
+        prompt_mask to continue its track instead.
+        """
+        # Modal methods and the HTTP endpoints' worker threads all hand off to
+        # the thread that captured the CUDA graphs
+        return self.gpu_thread.submit(
+            self._segment_chunk,
+            chunk_path,
+            frame_offsets,
+            width,
+            height,
+            feature_key,
+            prompt_mask,
+        ).result()
+
+    def _segment_chunk(self, chunk_path, frame_offsets, width, height, feature_key, prompt_mask):
+        import itertools
+        import mmap
         import time
 
-        import numpy as np
         import torch
-        from PIL import Image
 
         t0 = time.time()
+        jobs_vol.reload()
+
+        # Reuse image encoder outputs from an earlier run of the same chunk
+        feature_path = None
+        features_cached = False
+        if feature_key:
+            cache_vol.reload()
+            feature_path = FEATURE_CACHE_DIR / f"{feature_key}.pt"
+            features_cached = feature_path.exists()
+            self.video_predictor.frame_features = (
+                torch.load(feature_path, map_location="cuda", weights_only=True)
+                if features_cached
+                else {"backbone_fpn": {}}
+            )
 
-        # Write frames to temp dir for SAM2
-        tmp_dir = Path(tempfile.mkdtemp())
-        frames_dir = tmp_dir / "frames"
-        frames_dir.mkdir()
+        # Decode straight from the mapped chunk file into SAM2's input tensor.
+        # ACCESS_COPY views are writable, so torch.frombuffer needs no copy.
+        with (
+            open(chunk_path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) as buf,
+            memoryview(buf) as view,
+            torch.inference_mode(),
+        ):
+            frames = _decode_frames(
+                [view[start:end] for start, end in itertools.pairwise(frame_offsets)],
+                self.video_predictor.image_size,
+            )
+
+        masks = self._propagate(frames, width, height, prompt_mask)
+
+        if feature_path is not None and not features_cached:
+            feature_path.parent.mkdir(parents=True, exist_ok=True)
+            torch.save(self.video_predictor.frame_features, feature_path)
+            _evict_features(FEATURE_CACHE_MAX_BYTES)
+            cache_vol.commit()
+        self.video_predictor.frame_features = None
 
-        for i, jpg_bytes in enumerate(frame_jpegs):
-            (frames_dir / f"{i:05d}.jpg").write_bytes(jpg_bytes)
+        print(f"Chunk: {len(frame_offsets) - 1} frames in {time.time() - t0:.1f}s")
+        return masks
+
+    def _propagate(self, frames, width: int, height: int, prompt_mask=None) -> "np.ndarray":
+        """Prompt the first frame and track it through the rest.
+
+        frames is the (images, video_height, video_width) tuple from _decode_frames.
+        """
+        import numpy as np
+        import torch
 
         points = np.array([[width // 2, height // 2]], dtype=np.float32)
         labels = np.array([1], np.int32)
@@ -74,55 +688,108 @@ class SAM2Model:
             torch.inference_mode(),
             torch.autocast("cuda", dtype=torch.bfloat16),
         ):
-            inference_state = self.video_predictor.init_state(
-                video_path=str(frames_dir)
-            )
+            inference_state = self.video_predictor.init_state(video_path=frames)
+
+            if prompt_mask is None:
+                # Every chunk of this size gets the same center point prompt
+                self.video_predictor.prompt_cache_key = ("center", width, height)
+                try:
+                    self.video_predictor.add_new_points_or_box(
+                        inference_state=inference_state,
+                        frame_idx=0,
+                        obj_id=1,
+                        points=points,
+                        labels=labels,
+                    )
+                finally:
+                    self.video_predictor.prompt_cache_key = None
+            else:
+                self.video_predictor.add_new_mask(
+                    inference_state=inference_state,
+                    frame_idx=0,
+                    obj_id=1,
+                    mask=np.unpackbits(prompt_mask, axis=-1, count=width).astype(bool),
+                )
 
-            self.video_predictor.add_new_points_or_box(
-                inference_state=inference_state,
-                frame_idx=0,
-                obj_id=1,
-                points=points,
-                labels=labels,
+            # One 1-bit plane per frame, ready to be piped into ffmpeg as rawvideo.
+            # Copies land in pinned memory on a side stream, so they overlap with
+            # the next frame's propagation instead of syncing every frame.
+            row_bytes = (width + 7) // 8
+            mask_host = torch.zeros(
+                (len(frames[0]), height, row_bytes), dtype=torch.uint8, pin_memory=True
             )
+            copy_stream = torch.cuda.Stream()
+            # Propagated frames carry no prompt, SAM2 encodes the same padding point
+            self.video_predictor.prompt_cache_key = ("empty",)
+            try:
+                for out_frame_idx, out_obj_ids, out_mask_logits in self.video_predictor.propagate_in_video(
+                    inference_state
+                ):
+                    # Union of all objects, thresholded and bit-packed on the GPU
+                    mask_bits = torch.empty((height, row_bytes), dtype=torch.uint8, device="cuda")
+                    _pack_mask(out_mask_logits.amax(dim=0)[0].contiguous(), mask_bits)
+                    copy_stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(copy_stream):
+                        mask_host[out_frame_idx].copy_(mask_bits, non_blocking=True)
+                    mask_bits.record_stream(copy_stream)
+            finally:
+                self.video_predictor.prompt_cache_key = None
+            copy_stream.synchronize()
+
+        return mask_host.numpy()
 
-            video_segments = {}
-            for out_frame_idx, out_obj_ids, out_mask_logits in self.video_predictor.propagate_in_video(
-                inference_state
-            ):
-                video_segments[out_frame_idx] = {
-                    out_obj_id: (out_mask_logits[i] > 0.0).cpu().numpy()
-                    for i, out_obj_id in enumerate(out_obj_ids)
-                }
-
-        # Render masks as PNG bytes
-        mask_pngs = []
-        for frame_idx in range(len(frame_jpegs)):
-            mask_img = np.zeros((height, width, 3), dtype=np.uint8)
-            if frame_idx in video_segments:
-                for obj_id, mask in video_segments[frame_idx].items():
-                    mask_2d = mask.squeeze()
-                    mask_img[mask_2d] = [255, 255, 255]
-
-            buf = io.BytesIO()
-            Image.fromarray(mask_img).save(buf, format="PNG")
-            mask_pngs.append(buf.getvalue())
-
-        print(f"Chunk: {len(frame_jpegs)} frames in {time.time() - t0:.1f}s")
-        return mask_pngs
+    @modal.fastapi_endpoint(method="POST", docs=True)
+    async def segment(self, request: "fastapi.Request"):
+        """Accept raw video bytes as the request body, return the mask video as MP4."""
+        import asyncio
+        import tempfile
+
+        from blake3 import blake3
+        from fastapi import HTTPException
+        from fastapi.responses import FileResponse
+
+        # Stream the upload to disk, hashing as it arrives when the feature
+        # cache needs a content key
+        tmp_dir = Path(tempfile.mkdtemp())
+        input_path = tmp_dir / "input.mp4"
+        hasher = blake3() if FEATURE_CACHE else None
+        num_bytes = 0
+        with input_path.open("wb") as f:
+            async for chunk in request.stream():
+                if hasher is not None:
+                    hasher.update(chunk)
+                f.write(chunk)
+                num_bytes += len(chunk)
+
+        if not num_bytes:
+            raise HTTPException(status_code=400, detail="No video provided")
+        print(f"Received video: {num_bytes} bytes")
+
+        try:
+            output_path, stats = await asyncio.to_thread(
+                self._segment_file, input_path, hasher and hasher.hexdigest()
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        return FileResponse(
+            output_path,
+            media_type="video/mp4",
+            headers={
+                "X-Num-Frames": str(stats["num_frames"]),
+                "X-Fps": str(stats["fps"]),
+                "X-Chunks": str(stats["chunks"]),
+                "X-Processing-Time": str(stats["processing_time"]),
+            },
+        )
 
     @modal.fastapi_endpoint(method="POST", docs=True)
-    def segment(self, data: dict):
-        """Accept base64 video, split into chunks, process in parallel, return mask video."""
+    def segment_b64(self, data: dict):
+        """Accept base64 video, return base64 mask video (JSON clients)."""
         import base64
-        import subprocess
         import tempfile
-        import time
-
-        import ffmpeg
-        from PIL import Image
 
-        t0 = time.time()
+        from blake3 import blake3
 
         video_b64 = data.get("video_base64", "")
         if not video_b64:
@@ -138,101 +805,146 @@ class SAM2Model:
         input_path = tmp_dir / "input.mp4"
         input_path.write_bytes(video_bytes)
 
-        # Probe video
-        probe = ffmpeg.probe(str(input_path))
-        video_stream = next(
-            s for s in probe["streams"] if s["codec_type"] == "video"
-        )
-        fps_parts = video_stream["r_frame_rate"].split("/")
-        original_fps = int(fps_parts[0]) / int(fps_parts[1])
-
-        # Extract all frames at original fps
-        frames_dir = tmp_dir / "frames"
-        frames_dir.mkdir()
-        ffmpeg.input(str(input_path)).output(
-            f"{frames_dir}/%05d.jpg",
-            qscale=2,
-            start_number=0,
-        ).run(quiet=True)
-
-        frame_paths = sorted(
-            [p for p in frames_dir.iterdir() if p.suffix in [".jpg", ".jpeg"]],
-            key=lambda p: int(p.stem),
-        )
+        try:
+            output_path, stats = self._segment_file(
+                input_path, blake3(video_bytes).hexdigest() if FEATURE_CACHE else None
+            )
+        except ValueError as e:
+            return {"error": str(e)}
 
-        if not frame_paths:
-            return {"error": "No frames extracted from video"}
+        result_b64 = base64.b64encode(output_path.read_bytes()).decode("utf-8")
+        return {"mask_video_base64": result_b64, **stats}
 
-        # Get dimensions
-        first_img = Image.open(frame_paths[0])
-        width, height = first_img.size
+    def _segment_file(self, input_path: Path, video_key: str | None) -> tuple[Path, dict]:
+        """Split the video into chunks, process them in parallel, encode the mask video.
 
-        # Read all frame bytes
-        all_frame_bytes = [p.read_bytes() for p in frame_paths]
-        num_frames = len(all_frame_bytes)
+        video_key is the upload's content hash, or None when the feature cache is off.
+        """
+        import io
+        import itertools
+        import math
+        import shutil
+        import time
+        import uuid
 
-        print(f"Extracted {num_frames} frames at {original_fps:.1f}fps")
+        import av
+        from PIL import Image
 
-        # Split into chunks — dynamic size to stay within GPU limit
-        import math
-        num_chunks = min(MAX_PARALLEL_CHUNKS, num_frames)
-        frames_per_chunk = math.ceil(num_frames / num_chunks)
-        chunks = []
-        for i in range(0, num_frames, frames_per_chunk):
-            chunks.append(all_frame_bytes[i:i + frames_per_chunk])
-
-        print(f"Split into {len(chunks)} chunks for parallel processing")
-
-        # Process chunks in parallel using .map()
-        if len(chunks) == 1:
-            # Single chunk — just run directly (no overhead)
-            all_mask_pngs = self.segment_chunk.local(chunks[0], width, height)
-        else:
-            # Parallel across multiple containers
-            chunk_results = list(
-                self.segment_chunk.map(
-                    chunks,
-                    kwargs=dict(width=width, height=height),
+        t0 = time.time()
+        tmp_dir = input_path.parent
+
+        # Read stream metadata in-process rather than spawning ffprobe
+        with av.open(str(input_path)) as container:
+            video_stream = container.streams.video[0]
+            # image2pipe output is CFR: ffmpeg duplicates or drops frames to hit
+            # the guessed (r_frame_rate based) rate, so the masks must use it too
+            original_fps = float(video_stream.guessed_rate or video_stream.base_rate)
+
+            # Chunks are dispatched while ffmpeg is still decoding, so their size
+            # comes from the container's frame count rather than the decoded frames
+            est_frames = _estimate_frame_count(container, video_stream, original_fps)
+        # Split evenly across as many chunks as the floor allows, so the last
+        # chunk is not a short tail paying a full init_state and prompt
+        num_chunks = min(MAX_PARALLEL_CHUNKS, max(1, est_frames // MIN_FRAMES_PER_CHUNK))
+        frames_per_chunk = max(MIN_FRAMES_PER_CHUNK, math.ceil(est_frames / num_chunks))
+
+        # Spawn each chunk as soon as its frames are decoded. Frames travel via
+        # a file on jobs_vol rather than the call payload, so workers map them
+        # in place and re-seeded reruns read the same file. The last chunk
+        # absorbs frames beyond the estimate and runs on this container's GPU.
+        for stale_dir in JOB_DIR.iterdir():
+            if time.time() - stale_dir.stat().st_mtime > JOB_MAX_AGE_SECONDS:
+                shutil.rmtree(stale_dir, ignore_errors=True)
+        job_dir = JOB_DIR / uuid.uuid4().hex
+        job_dir.mkdir(parents=True)
+        width = height = None
+        chunk = []
+        chunk_files = []  # (path, frame offsets) per chunk
+        calls = []
+
+        def write_chunk():
+            path = job_dir / f"{len(chunk_files):03d}.bin"
+            with path.open("wb") as f:
+                f.writelines(chunk)
+            chunk_files.append((str(path), [0, *itertools.accumulate(map(len, chunk))]))
+            chunk.clear()
+            jobs_vol.commit()
+
+        def feature_key(chunk_idx: int) -> str | None:
+            if video_key is None:
+                return None
+            # Chunk boundaries are deterministic for a given video
+            num_chunk_frames = len(chunk_files[chunk_idx][1]) - 1
+            return f"{video_key}_{SAM2_IMAGE_SIZE}_{chunk_idx}_{num_chunk_frames}"
+
+        try:
+            for jpg_bytes in _stream_jpegs(input_path):
+                if width is None:
+                    # Get dimensions (after ffmpeg's autorotation)
+                    width, height = Image.open(io.BytesIO(jpg_bytes)).size
+                if len(chunk) >= frames_per_chunk and len(chunk_files) < num_chunks - 1:
+                    write_chunk()
+                    calls.append(
+                        self.segment_chunk.spawn(
+                            *chunk_files[-1],
+                            width=width,
+                            height=height,
+                            feature_key=feature_key(len(chunk_files) - 1),
+                        )
+                    )
+                chunk.append(jpg_bytes)
+
+            if not chunk:
+                raise ValueError("No frames extracted from video")
+            write_chunk()
+            num_frames = sum(len(offsets) - 1 for _, offsets in chunk_files)
+
+            print(f"Extracted {num_frames} frames at {original_fps:.1f}fps into {len(chunk_files)} chunks")
+
+            def chunk_masks():
+                # Spawned chunks keep running remotely while the last one runs here
+                last_masks = self.segment_chunk.local(
+                    *chunk_files[-1], width, height, feature_key=feature_key(len(chunk_files) - 1)
                 )
-            )
-            # Flatten results
-            all_mask_pngs = []
-            for chunk_masks in chunk_results:
-                all_mask_pngs.extend(chunk_masks)
-
-        # Write mask PNGs to disk
-        mask_dir = tmp_dir / "masks"
-        mask_dir.mkdir()
-        for i, png_bytes in enumerate(all_mask_pngs):
-            (mask_dir / f"{i:05d}.png").write_bytes(png_bytes)
-
-        # Encode to video
-        output_path = tmp_dir / "mask.mp4"
-        cmd = [
-            "ffmpeg", "-y",
-            "-framerate", str(original_fps),
-            "-i", f"{mask_dir}/%05d.png",
-            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
-            "-c:v", "libx264",
-            "-pix_fmt", "yuv420p",
-            str(output_path),
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"ffmpeg stderr: {result.stderr}")
-            raise RuntimeError(f"ffmpeg failed: {result.stderr[-500:]}")
-
-        result_bytes = output_path.read_bytes()
-        result_b64 = base64.b64encode(result_bytes).decode("utf-8")
+                results = itertools.chain((call.get() for call in calls), [last_masks])
+
+                prev_masks = None
+                reseeds = 0
+                for chunk_idx, masks in enumerate(results):
+                    # Chunks start from independent center-point prompts. If one picked
+                    # up a different object than its predecessor ended on, rerun it
+                    # seeded with that last mask.
+                    if prev_masks is not None and prev_masks[-1].any():
+                        iou = _mask_iou(prev_masks[-1], masks[0])
+                        if iou < HANDOFF_MIN_IOU and reseeds >= MAX_RESEEDS:
+                            print(f"Chunk {chunk_idx}: IoU {iou:.2f} at boundary, re-seed limit reached")
+                        elif iou < HANDOFF_MIN_IOU:
+                            reseeds += 1
+                            print(f"Chunk {chunk_idx}: IoU {iou:.2f} at boundary, re-seeding")
+                            masks = self.segment_chunk.local(
+                                *chunk_files[chunk_idx],
+                                width,
+                                height,
+                                feature_key=feature_key(chunk_idx),
+                                prompt_mask=prev_masks[-1],
+                            )
+                    yield masks
+                    prev_masks = masks
+
+            # Encode to video, streaming masks into ffmpeg as chunks come back
+            output_path = tmp_dir / "mask.mp4"
+            _encode_mask_video(chunk_masks(), width, height, original_fps, output_path)
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            jobs_vol.commit()
 
         total_time = time.time() - t0
-        print(f"Total: {total_time:.1f}s, {num_frames} frames, {len(chunks)} chunks, output: {len(result_bytes)} bytes")
+        print(f"Total: {total_time:.1f}s, {num_frames} frames, {len(chunk_files)} chunks, output: {output_path.stat().st_size} bytes")
 
-        return {
-            "mask_video_base64": result_b64,
+        return output_path, {
             "num_frames": num_frames,
             "fps": original_fps,
             "original_fps": original_fps,
-            "chunks": len(chunks),
+            "chunks": len(chunk_files),
             "processing_time": round(total_time, 1),
         }
@@ -81,16 +81,26 @@ async def segment_video(input_data: dict) -> dict:
     if not frame_names:
         return {"error": "No frames extracted from video"}
 
-    # Load SAM2 model (cached in globals after first load on this worker)
-    import builtins
-    if not hasattr(builtins, "_sam2_predictor"):
-        from sam2.sam2_video_predictor import SAM2VideoPredictor
-        builtins._sam2_predictor = SAM2VideoPredictor.from_pretrained(
-            "facebook/sam2-hiera-large"
-        )
-        print("SAM2 model loaded and cached")
-
-    video_predictor = builtins._sam2_predictor
+    # Load SAM2 model once per worker. Only this function's body is shipped to
+    # the worker, so the cache lives in a module registered in sys.modules,
+    # and the lock keeps concurrent first requests from loading it twice.
+    import sys
+    import threading
+    import types
+
+    cache = sys.modules.setdefault("_sam2_worker_cache", types.ModuleType("_sam2_worker_cache"))
+    lock = cache.__dict__.setdefault("lock", threading.Lock())
+    if getattr(cache, "predictor", None) is None:
+        with lock:
+            if getattr(cache, "predictor", None) is None:
+                from sam2.sam2_video_predictor import SAM2VideoPredictor
+                cache.predictor = SAM2VideoPredictor.from_pretrained(
+                    "facebook/sam2-hiera-large"
+                )
+                torch.cuda.empty_cache()
+                print("SAM2 model loaded and cached")
+
+    video_predictor = cache.predictor
 
     # Use center of first frame as initial point
     width, height = Image.open(frame_names[0]).size
@@ -112,26 +122,9 @@ async def segment_video(input_data: dict) -> dict:
         for out_frame_idx, out_obj_ids, out_mask_logits in video_predictor.propagate_in_video(
             inference_state
         ):
-            video_segments[out_frame_idx] = {
-                out_obj_id: (out_mask_logits[i] > 0.0).cpu().numpy()
-                for i, out_obj_id in enumerate(out_obj_ids)
-            }
-
-    # Render mask frames
-    mask_dir = tmp_dir / "masks"
-    mask_dir.mkdir()
-
-    for frame_idx in range(len(frame_names)):
-        frame = Image.open(frame_names[frame_idx])
-        w, h = frame.size
-        mask_img = np.zeros((h, w, 3), dtype=np.uint8)
-
-        if frame_idx in video_segments:
-            for obj_id, mask in video_segments[frame_idx].items():
-                mask_2d = mask.squeeze()
-                mask_img[mask_2d] = [255, 255, 255]
-
-        Image.fromarray(mask_img).save(mask_dir / f"{frame_idx:05d}.png")
+            # Union of all objects, thresholded and packed to 0/255 on the GPU
+            mask_u8 = (out_mask_logits > 0.0).any(dim=0).squeeze(0).to(torch.uint8).mul_(255)
+            video_segments[out_frame_idx] = mask_u8.cpu().numpy()
 
     # Get input video fps
     import ffmpeg as ffmpeg_lib
@@ -140,20 +133,32 @@ async def segment_video(input_data: dict) -> dict:
     fps_parts = video_stream["r_frame_rate"].split("/")
     fps = int(fps_parts[0]) / int(fps_parts[1])
 
-    # Encode mask frames to video
+    # Encode masks to video, piping raw gray frames into ffmpeg's stdin
     output_path = tmp_dir / "mask.mp4"
     cmd = [
         "ffmpeg", "-y",
+        "-loglevel", "error",
+        "-f", "rawvideo",
+        "-pix_fmt", "gray",
+        "-s", f"{width}x{height}",
         "-framerate", str(fps),
-        "-i", f"{mask_dir}/%05d.png",
+        "-i", "-",
         "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
         "-c:v", "libx264",
         "-pix_fmt", "yuv420p",
         str(output_path),
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        return {"error": f"ffmpeg encode failed: {result.stderr[-500:]}"}
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    empty_mask = np.zeros((height, width), dtype=np.uint8)
+    try:
+        for frame_idx in range(len(frame_names)):
+            proc.stdin.write(video_segments.get(frame_idx, empty_mask))
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass  # ffmpeg exited early, its stderr says why
+    stderr = proc.stderr.read().decode()
+    if proc.wait() != 0:
+        return {"error": f"ffmpeg encode failed: {stderr[-500:]}"}
 
     result_bytes = output_path.read_bytes()
     result_b64 = base64.b64encode(result_bytes).decode("utf-8")
@@ -7,7 +7,7 @@ dotenv.config();
 const app = express();
 const port = 3001;
 
-// Modal endpoint URL - set after deploying with `modal deploy modal_sam2.py`
+// Modal segment_b64 endpoint URL (JSON/base64) - set after deploying with `modal deploy modal_sam2.py`
 const MODAL_ENDPOINT_URL = process.env.MODAL_ENDPOINT_URL;
 
 app.use(cors({